@@ -8,7 +8,9 @@
 
 from __future__ import annotations
 
+import io
 import os
+import re
 import shutil
 import subprocess
 import argparse
@@ -16,29 +18,131 @@ import logging
 import requests
 import json
 import zipfile
+import zlib
 import websocket
+import socket
 import urllib.parse
 import traceback
+import threading
+import asyncio
+import importlib.util
+import tempfile
 
 from pathlib import Path
-from itertools import takewhile
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util.request import ACCEPT_ENCODING
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from bisect import bisect_left
 from enum import IntEnum, unique
 from time import sleep, time
-from datetime import datetime
-from bs4 import BeautifulSoup
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable
+
+try:
+    from requests_toolbelt import MultipartEncoder
+except ImportError:
+    MultipartEncoder = None  # type: ignore
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+try:
+    import httpx
+except ImportError:
+    httpx = None  # type: ignore
+# HTTP/2 support of httpx requires the `h2` package
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
 
 
 OVERLEAF_URL = "https://overleaf.s3lab.io"
 LOGIN_URL = f"{OVERLEAF_URL}/login"
 PROJECTS_URL = f"{OVERLEAF_URL}/project"
 
+CSRF_INPUT_RE = re.compile(rb'<input[^>]*name="_csrf"[^>]*value="([^"]+)"')
+CSRF_META_RE = re.compile(rb'<meta[^>]*name="ol-csrfToken"[^>]*content="([^"]+)"')
+
 OVERLEAF_SYNC_DIR_NAME = ".overleaf-sync"
 
+# Cached sessions older than this (in seconds) are not reused
+SESSION_TTL = 3000
+
+UNZIP_MAX_WORKERS = os.cpu_count() or 1
+UNZIP_BUFFER_SIZE = 1 << 20
+DOWNLOAD_BUFFER_SIZE = 1 << 20
+ZIP_IN_MEMORY_MAX_SIZE = 64 << 20
+HTTP_MAX_WORKERS = 8
+HTTP_POOL_SIZE = 32
+WEBSOCKET_TIMEOUT = 30
+# Overleaf allows 200 uploads per 15 minutes: burst the whole budget, then refill it over the window.
+# The rate (requests per second) is still halved on HTTP 429/503.
+UPLOAD_BURST = 200
+UPLOAD_RATE = UPLOAD_BURST / 900
+UPLOAD_MAX_ATTEMPTS = 5
+# Upper bound of a honored `Retry-After`, matching the 15 minutes window of the upload rate limit
+RETRY_AFTER_MAX = 900
+# Files larger than this are uploaded with fewer concurrent workers
+UPLOAD_LARGE_FILE_SIZE = 1 << 20
+UPLOAD_LARGE_MAX_WORKERS = 2
+
 LOG_FORMAT = "[%(asctime)s.%(msecs)03d] [%(name)s] [%(levelname)s] %(message)s"
 LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
 LOG_DIR = os.path.join(OVERLEAF_SYNC_DIR_NAME, "logs")
 
 
+def json_loads(data: bytes | memoryview | str) -> Any:
+    """Parse JSON with `orjson` if available, which parses UTF-8 bytes and memoryviews directly"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data.tobytes() if isinstance(data, memoryview) else data)
+
+
+def json_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
+
+def parse_retry_after(value: str | None, default: float = 5) -> float:
+    """Seconds to wait from a `Retry-After` header, given either as seconds or as an HTTP date"""
+    if value is None:
+        return default
+    try:
+        retry_after = float(value)
+    except ValueError:
+        try:
+            retry_after = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return default
+    return min(max(retry_after, 0), RETRY_AFTER_MAX)
+
+
+def diff_to_content(diff: list[dict]) -> bytes:
+    """Content of a doc at the end of its Overleaf diff"""
+    # Join once instead of `+=` which copies the content for every diff entry
+    parts: list[str] = []
+    for d in diff:
+        if "u" in d:
+            parts.append(d["u"])
+        elif "i" in d:
+            parts.append(d["i"])
+        elif "d" not in d:
+            raise ValueError(f"Unsupported diff entry: {list(d.keys())}")
+    return "".join(parts).encode()
+
+
+def file_crc32(path: str) -> int:
+    """CRC32 of a file as stored in ZIP central directories"""
+    crc = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(UNZIP_BUFFER_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
 def setup_logger(logger: logging.Logger, debug: bool, log_file: bool = True) -> None:
     logger.setLevel(logging.DEBUG)
     ch = logging.StreamHandler()
@@ -73,16 +177,70 @@ class ErrorNumber(IntEnum):
     REINITIALIZATION_ERROR = 9
 
 
+class RateLimiter:
+    """
+    Thread-safe token bucket which halves its rate whenever the server asks to slow down.
+    The rate never drops below `min_rate` (an eighth of the initial rate by default) and recovers step by step
+    with every success once the server stops throttling.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, min_rate: float | None = None) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = rate / 8 if min_rate is None else min_rate
+        self._tokens = float(burst)
+        self._ts = time()
+        # End of the window in which the server asked not to send requests; `acquire` never moves it
+        self._penalty_until: float = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time()
+            self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate)
+            self._ts = now
+            # Reserve a token even if it is not available yet; later callers queue up behind it
+            self._tokens -= 1
+            time_to_sleep = -self._tokens / self.rate if self._tokens < 0 else 0
+        sleep(time_to_sleep)
+
+    def penalize(self, retry_after: float) -> None:
+        with self._lock:
+            now = time()
+            if self._ts <= now:
+                # Credit the refill so far; a refill starting in the future has nothing to credit
+                self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+            if now >= self._penalty_until:
+                # Workers throttled within the same window slow the bucket down only once
+                self.rate = max(self.min_rate, self.rate / 2)
+            self._penalty_until = max(self._penalty_until, now + retry_after)
+            # No token is available until the window ends
+            self._tokens = min(self._tokens, 0)
+            self._ts = max(self._ts, self._penalty_until)
+
+    def recover(self) -> None:
+        with self._lock:
+            if time() >= self._penalty_until:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 8)
+
+
 class GitBroker:
     logger = logging.getLogger(__qualname__)
     WORKING_BRANCH_START_COMMIT_TAG = "ws"
+    # Commands that never change the repository; any other command invalidates the memoized queries
+    READ_ONLY_COMMANDS = frozenset(["ls-files", "rev-parse", "status", "log", "diff", "diff-tree"])
 
     def __init__(self, working_dir, overleaf_branch="overleaf", working_branch="working") -> None:
         self.working_dir = working_dir
         self.overleaf_branch = overleaf_branch
         self.working_branch = working_branch
+        self._cache: dict[str, Any] = {}
 
     def __call__(self, *args: str, check=True) -> str:
+        if not (args[0] in self.READ_ONLY_COMMANDS or args[:2] in (("branch", "--list"), ("branch", "--show-current"))):
+            self._cache.clear()
         cmd = ["git", "-C", self.working_dir, *args]
         self.logger.debug("Git command: %s", " ".join(cmd))
         try:
@@ -122,9 +280,14 @@ class GitBroker:
             )
             exit(ErrorNumber.WKDIR_CORRUPTED_ERROR)
 
+    def _cached(self, key: str, compute: Callable[[], Any]) -> Any:
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
     @property
     def managed_files(self) -> list[str]:
-        return self("ls-files").splitlines()
+        return self._cached("managed_files", lambda: self("ls-files").splitlines())
 
     def add_all(self) -> bool:
         output = self("add", ".")
@@ -133,10 +296,14 @@ class GitBroker:
             return False
         return True
 
-    def commit(self, msg: str, ts: int, name: str, email: str) -> None:
+    def commit(self, msg: str, ts: int, name: str, email: str, all=False) -> None:
+        """
+        `all`: Also stage modified and deleted tracked files, saving a separate `git add` for them.
+        """
         self(
             "commit",
             "--allow-empty",
+            *(["--all"] if all else []),
             f"--date=@{ts}",
             f"--author={name} <{email}>",
             "-m",
@@ -147,11 +314,13 @@ class GitBroker:
     def starting_working_commit(self) -> str:
         # The first commit ID where working branch forked from overleaf branch
         # return self("merge-base", self.overleaf_branch, self.overleaf_branch)
-        return self("rev-parse", self.WORKING_BRANCH_START_COMMIT_TAG)
+        return self._cached(
+            "starting_working_commit", lambda: self("rev-parse", self.WORKING_BRANCH_START_COMMIT_TAG)
+        )
 
     @property
     def current_working_commit(self) -> str:
-        return self("rev-parse", self.working_branch)
+        return self._cached("current_working_commit", lambda: self("rev-parse", self.working_branch))
 
     @property
     def is_current_branch_clean(self) -> bool:
@@ -176,7 +345,10 @@ class GitBroker:
     @property
     def local_overleaf_version(self) -> int:
         """The latest overleaf update in local git repository"""
-        return int(self("log", "-1", "--pretty=%B", self.overleaf_branch).split("->")[1])
+        return self._cached(
+            "local_overleaf_version",
+            lambda: int(self("log", "-1", "--pretty=%B", self.overleaf_branch).split("->")[1]),
+        )
 
     def reset_hard(self, n: int) -> None:
         self("reset", "--hard", f"HEAD~{n}")
@@ -208,7 +380,7 @@ class GitBroker:
 
     @property
     def current_branch(self) -> str:
-        return self("branch", "--show-current")
+        return self._cached("current_branch", lambda: self("branch", "--show-current"))
 
     def stash_working(self) -> bool:
         if not self.current_branch == self.working_branch:
@@ -222,9 +394,18 @@ class GitBroker:
         self("stash", "pop")
 
     @property
-    def working_branch_status(self) -> list[str]:
+    def working_branch_status(self) -> list[list[str]]:
+        """Changes of working branch as `[status, pathname]`, or `[status, old, new]` for copies and renames"""
         assert self.current_branch == self.working_branch
-        return self("diff", "--name-status", self.WORKING_BRANCH_START_COMMIT_TAG).splitlines()
+        # NUL-separated fields keep pathnames with tabs, newlines or non-ASCII characters unquoted
+        fields = self("diff", "--name-status", "-z", self.WORKING_BRANCH_START_COMMIT_TAG).split("\0")
+        status: list[list[str]] = []
+        i = 0
+        while i < len(fields) and fields[i]:
+            num_columns = 3 if fields[i][0] in "RC" else 2
+            status.append(fields[i : i + num_columns])
+            i += num_columns
+        return status
 
 
 class OverleafBroker:
@@ -237,25 +418,48 @@ class OverleafBroker:
         self.overleaf_zip = os.path.join(self.overleaf_sync_dir, "overleaf.zip")
         self.ids_file = os.path.join(self.overleaf_sync_dir, "ids.json")
         self.indexed_ids_file = os.path.join(self.overleaf_sync_dir, "indexed_ids.json")
+        self.session_file = os.path.join(self.overleaf_sync_dir, "session.json")
+        self.updates_etag_file = os.path.join(self.overleaf_sync_dir, "updates.etag")
         self._session = requests.Session()
         self._session.headers.update(
             {
-                "Accept-Encoding": "gzip, deflate, br, zstd",
+                # Only advertise the encodings urllib3 can decode with the installed packages (brotli, zstandard)
+                "Accept-Encoding": ACCEPT_ENCODING,
                 "Accept-Language": "en-US,en;q=0.9,zh;q=0.8",
                 "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36 Edg/131.0.0.0",
             }
         )
+        # Keep enough keep-alive connections for the concurrent requests, and retry transient server errors and
+        # throttling, honoring `Retry-After`.
+        # POST is not retried: upload bodies are streamed and cannot be replayed, and 429 is handled by `upload`.
+        retry = Retry(
+            total=5,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(["GET", "DELETE"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
         self.username: str | None = None
         self.password: str | None = None
         self.project_id: str | None = None
         self._logged_in = False
+        self._login_ts: float = 0
+        # Reentrant, as fetching the CSRF token after logging in may go through `_request` and `_save_session`
+        self._login_lock = threading.RLock()
         self._updates_min_count: int = 100
         self._updates: list[dict] | None = None
+        self._updates_etag: str | None = None
         self._csrf_token: str | None = None
         self._download_zip_ts: float = 0
+        self._overleaf_zip_data: bytes | None = None
+        self._upload_rate_limiter = RateLimiter(UPLOAD_RATE, UPLOAD_BURST)
         self._original_file_ids: dict | None = None
         self._root_folder_id: str | None = None
         self._indexed_file_ids: dict[str, dict[str, str]] | None = None
+        self._flat_ids: dict[str, tuple[str, str]] | None = None
 
     @property
     def project_url(self) -> str:
@@ -264,7 +468,28 @@ class OverleafBroker:
     def _request(self, method: str, url: str, **kwargs) -> requests.Response:
         if not self._logged_in:
             self.logger.error("Not logged in. Please login first")
+        login_ts = self._login_ts
         response = self._session.request(method, url, **kwargs)
+        headers: dict = kwargs.get("headers") or {}
+        # A cached session or CSRF token may have expired on the server side
+        if response.url.split("?")[0] == LOGIN_URL or (
+            response.status_code in (401, 403, 419) and "X-CSRF-TOKEN" in headers
+        ):
+            # Release the pooled connection of a streamed response before logging in and sending again
+            response.close()
+            # Concurrent workers see the expiry together; only the first one logs in again
+            with self._login_lock:
+                if self._login_ts == login_ts:
+                    self.logger.warning("Overleaf session expired (HTTP %d). Logging in again...", response.status_code)
+                    self._login()
+                csrf_token = self.csrf_token if "X-CSRF-TOKEN" in headers else None
+            files: dict = kwargs.get("files") or {}
+            if hasattr(kwargs.get("data"), "read") or any(hasattr(_[1], "read") for _ in files.values()):
+                # Streamed request bodies are already consumed and cannot be replayed
+                raise requests.HTTPError(f"Overleaf session expired: {method} {url}", response=response)
+            if csrf_token:
+                headers["X-CSRF-TOKEN"] = csrf_token
+            response = self._session.request(method, url, **kwargs)
         response.raise_for_status()
         return response
 
@@ -285,19 +510,72 @@ class OverleafBroker:
         self.password = password
         self.project_id = project_id
 
+        if self._load_session():
+            self._logged_in = True
+            self.logger.info("Reusing cached Overleaf session")
+            return
+        self._login()
+
+    def _login(self) -> None:
         self.logger.info("Logging in to Overleaf...")
+        self._session.cookies.clear()
+        self._csrf_token = None
         response = self._session.get(LOGIN_URL)
-        soup = BeautifulSoup(response.text, "html.parser")
-        csrf_token: str
-        csrf_token = soup.find("input", {"name": "_csrf"})["value"]  # type: ignore
-        if not csrf_token:
+        if not (match := CSRF_INPUT_RE.search(response.content)):
             raise ValueError("Failed to fetch CSRF token")
+        csrf_token = match.group(1).decode()
         payload = {"email": self.username, "password": self.password, "_csrf": csrf_token}
         response = self._session.post(LOGIN_URL, data=payload)
+        # The page landed on after login may already carry the session CSRF token, saving a project page fetch
+        if match := CSRF_META_RE.search(response.content):
+            self._csrf_token = match.group(1).decode()
         self._logged_in = True
+        self._login_ts = time()
+        self._save_session()
         self.logger.info("Login successful")
 
-    def _get_updates(self, before=0) -> tuple[list[dict], int]:
+    def _load_session(self) -> bool:
+        """
+        Restore the session cookies and CSRF token of a previous run if they are younger than `SESSION_TTL`.
+        """
+        try:
+            with open(self.session_file, "r") as f:
+                session: dict = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        if session.get("username") != self.username or time() - session.get("ts", 0) >= SESSION_TTL:
+            return False
+        for cookie in session["cookies"]:
+            self._session.cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"])
+        self._csrf_token = session.get("csrf_token")
+        self._login_ts = session["ts"]
+        return True
+
+    def _save_session(self) -> None:
+        # Cookies may be refreshed by a concurrent re-login
+        with self._login_lock:
+            session = {
+                "username": self.username,
+                "ts": self._login_ts,
+                "cookies": [
+                    {"name": _.name, "value": _.value, "domain": _.domain, "path": _.path}
+                    for _ in self._session.cookies
+                ],
+                "csrf_token": self._csrf_token,
+            }
+            # Write atomically so that an interrupted run never leaves a truncated session file behind.
+            # Each writer gets its own temporary file, so concurrent runs cannot move or truncate each other's.
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.overleaf_sync_dir, prefix="session.json.", suffix=".tmp", delete=False
+            ) as f:
+                json.dump(session, f)
+            os.replace(f.name, self.session_file)
+
+    def _get_updates(self, before=0, etag: str | None = None) -> tuple[list[dict], int] | None:
+        """
+        Fetch one page of project updates.
+        Return `None` if `etag` is given and the server reports the updates as not modified.
+        """
         url = (
             f"{PROJECTS_URL}/{self.project_id}/updates?before={before}"
             if before > 0
@@ -306,28 +584,56 @@ class OverleafBroker:
         headers = {
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
         }
+        if etag:
+            headers["If-None-Match"] = etag
         self.logger.debug("Fetching project updates from %s...", url)
         response = self._get(url, headers=headers)
-        response_json: dict = response.json()
+        if response.status_code == 304:
+            return None
+        if before == 0:
+            self._updates_etag = response.headers.get("ETag")
+        response_json: dict = json_loads(response.content)
         return response_json["updates"], response_json.get("nextBeforeTimestamp", 0)
 
     def get_updates(self, before=0) -> list[dict]:
-        updates, _ = self._get_updates(before)
+        updates, _ = self._get_updates(before) or ([], 0)
         if not updates:
             raise ValueError("Failed to fetch project updates")
         return updates
 
     def dump_updates(self) -> None:
-        with open(self.updates_file, "w") as f:
-            json.dump(self.updates, f)
+        with open(self.updates_file, "wb") as f:
+            f.write(json_dumps(self.updates))
+        with open(self.updates_etag_file, "w") as f:
+            f.write(self._updates_etag or "")
+
+    def _load_updates(self) -> tuple[list[dict], str] | tuple[None, None]:
+        """Load the updates dumped by a previous run together with the ETag they were fetched with"""
+        try:
+            with open(self.updates_etag_file, "r") as f:
+                etag = f.read().strip()
+            with open(self.updates_file, "rb") as f:
+                updates: list[dict] = json_loads(f.read())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None, None
+        if not etag or not updates:
+            return None, None
+        return updates, etag
 
     @property
     def updates(self) -> list[dict]:
-        if self._updates:
+        # Memoized until `refresh_updates`, so repeated accesses during a migration never hit the server again
+        if self._updates is not None:
             return self._updates
-        self._updates, next_before_ts = self._get_updates()
+        cached_updates, etag = self._load_updates()
+        # The first page carries the latest update, so an unchanged first page means unchanged updates
+        if (result := self._get_updates(etag=etag)) is None:
+            self.logger.debug("Project updates not modified since last fetch")
+            self._updates = cached_updates
+            return self._updates  # type: ignore
+        self._updates, next_before_ts = result
         while next_before_ts > 0:
-            updates, next_before_ts = self._get_updates(before=next_before_ts)
+            updates, next_before_ts = self._get_updates(before=next_before_ts)  # type: ignore
             self._updates.extend(updates)
         self.dump_updates()
         return self._updates
@@ -356,36 +662,87 @@ class OverleafBroker:
         url = f"{self.project_url}/version/{update}/zip" if update else f"{self.project_url}/download/zip"
         self.logger.debug("Downloading project ZIP from url: %s...", url)
         _sleep_until(self._download_zip_ts + 120)
-        response = self._get(url)
+        # The rate limit counts requests, so pace from the start of the request rather than the end of the transfer
         self._download_zip_ts = time()
-        with open(self.overleaf_zip, "wb") as f:
-            f.write(response.content)
+        self._overleaf_zip_data = None
+        with self._get(url, stream=True) as response:
+            # Honor the transparent content decoding advertised in `Accept-Encoding`
+            response.raw.decode_content = True
+            content_length = int(response.headers.get("Content-Length", -1))
+            if 0 <= content_length <= ZIP_IN_MEMORY_MAX_SIZE:
+                # Small ZIPs are extracted from memory, saving the write and read back of a temporary file
+                self._overleaf_zip_data = response.raw.read()
+                self.logger.debug("Project ZIP downloaded in memory (%d bytes)", len(self._overleaf_zip_data))
+                return
+            # Stream the ZIP to disk instead of buffering the whole file in memory
+            with open(self.overleaf_zip, "wb") as f:
+                shutil.copyfileobj(response.raw, f, DOWNLOAD_BUFFER_SIZE)
         self.logger.debug("Project ZIP downloaded as %s", self.overleaf_zip)
 
+    def _open_zip(self) -> zipfile.ZipFile:
+        """Open the downloaded ZIP file, from memory if it was small enough to be kept there"""
+        if self._overleaf_zip_data is not None:
+            # `BytesIO` shares the immutable buffer, so every handle reads the same memory without a copy
+            return zipfile.ZipFile(io.BytesIO(self._overleaf_zip_data), "r")
+        return zipfile.ZipFile(self.overleaf_zip, "r")
+
     def unzip(self, file_list: list | None = None) -> None:
         """
         Unzip the downloaded ZIP file to the LaTeX project directory.
         `file_list`: List of files to extract. If `None`, extract all files.
         """
-        self.logger.debug("Unzipping file %s to directory %s...", self.overleaf_zip, self.working_dir)
-        with zipfile.ZipFile(self.overleaf_zip, "r") as zip_ref:
-            if file_list:
-                # TODO: not tested
-                for file in zip_ref.filelist:
-                    self.logger.debug("Extracting %s...", file)
-                    zip_ref.extract(file, self.working_dir)
+        self.logger.debug("Unzipping project ZIP to directory %s...", self.working_dir)
+        with self._open_zip() as zip_ref:
+            zip_infos = zip_ref.infolist()
+        if file_list:
+            # TODO: not tested
+            file_set = set(file_list)
+            zip_infos = [_ for _ in zip_infos if _.filename in file_set]
+        # Drop unsafe entries once up front, so that no directory is created for them either
+        safe_zip_infos: list[zipfile.ZipInfo] = []
+        for zip_info in zip_infos:
+            if os.path.isabs(zip_info.filename) or ".." in zip_info.filename.split("/"):
+                self.logger.warning("Skipping unsafe ZIP entry %s", zip_info.filename)
             else:
-                zip_ref.extractall(self.working_dir)
+                safe_zip_infos.append(zip_info)
+        zip_infos = safe_zip_infos
+
+        # Create all parent directories beforehand to avoid `os.makedirs` races between workers
+        for dirname in {os.path.dirname(_.filename) for _ in zip_infos}:
+            os.makedirs(os.path.join(self.working_dir, dirname), exist_ok=True)
+
+        def _extract(chunk: list[zipfile.ZipInfo]) -> None:
+            # `ZipFile` is not thread-safe, so each worker reads from its own handle
+            with self._open_zip() as zip_ref:
+                for zip_info in chunk:
+                    if zip_info.is_dir():
+                        continue
+                    path = os.path.join(self.working_dir, zip_info.filename)
+                    # Reading back the local file is much cheaper than decompressing and rewriting it
+                    if os.path.isfile(path) and os.path.getsize(path) == zip_info.file_size:
+                        if file_crc32(path) == zip_info.CRC:
+                            self.logger.debug("Skipping unchanged %s...", zip_info.filename)
+                            continue
+                    self.logger.debug("Extracting %s...", zip_info.filename)
+                    # `ZipFile.extract` copies with a small buffer, which is slow for large binary assets
+                    with zip_ref.open(zip_info) as src, open(path, "wb") as dst:
+                        shutil.copyfileobj(src, dst, UNZIP_BUFFER_SIZE)
+
+        # Decompression happens in zlib with the GIL released, so threads scale with cores
+        max_workers = min(UNZIP_MAX_WORKERS, len(zip_infos)) or 1
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Consume the results to propagate exceptions raised in workers
+            list(executor.map(_extract, (zip_infos[i::max_workers] for i in range(max_workers))))
 
     @property
     def csrf_token(self) -> str:
         if self._csrf_token:
             return self._csrf_token
         response = self._get(self.project_url)
-        soup = BeautifulSoup(response.text, "html.parser")
-        self._csrf_token = soup.find("meta", {"name": "ol-csrfToken"})["content"]  # type: ignore
-        if not self._csrf_token:
+        if not (match := CSRF_META_RE.search(response.content)):
             raise ValueError("Failed to fetch CSRF token")
+        self._csrf_token = match.group(1).decode()
+        self._save_session()
         return self._csrf_token
 
     def filetree_diff(self, from_: int, to_: int) -> list[dict]:
@@ -397,18 +754,57 @@ class OverleafBroker:
             "X-CSRF-TOKEN": self.csrf_token,
         }
         response = self._get(url, headers=headers)
-        return response.json()["diff"]
+        return json_loads(response.content)["diff"]
 
-    def diff(self, from_: int, to_: int, pathname: str) -> list[dict]:
-        self.logger.debug("Fetching diff of file `%s` from %d to %d...", pathname, from_, to_)
+    def _diff_url_headers(self, from_: int, to_: int, pathname: str) -> tuple[str, dict[str, str]]:
         url = f"{PROJECTS_URL}/{self.project_id}/diff?from={from_}&to={to_}&pathname={urllib.parse.quote(pathname)}"
         headers = {
             "Accept": "application/json",
             "Referer": self.project_url,
             "X-CSRF-TOKEN": self.csrf_token,
         }
+        return url, headers
+
+    def diff(self, from_: int, to_: int, pathname: str) -> list[dict]:
+        self.logger.debug("Fetching diff of file `%s` from %d to %d...", pathname, from_, to_)
+        url, headers = self._diff_url_headers(from_, to_, pathname)
         response = self._get(url, headers=headers)
-        return response.json()["diff"]
+        return json_loads(response.content)["diff"]
+
+    async def _diffs_http2(self, from_: int, to_: int, pathnames: list[str]) -> dict[str, list[dict]]:
+        """Fetch the diffs of multiple files multiplexed on a single HTTP/2 connection"""
+        # `Accept-Encoding` is left to httpx, which only advertises the encodings it can decode
+        headers = {k: v for k, v in self._session.headers.items() if k != "Accept-Encoding"}
+        async with httpx.AsyncClient(http2=True, headers=headers) as client:
+            for cookie in self._session.cookies:
+                client.cookies.set(cookie.name, cookie.value or "", domain=cookie.domain, path=cookie.path)
+            url_headers = [self._diff_url_headers(from_, to_, _) for _ in pathnames]
+            responses = await asyncio.gather(
+                *(client.get(url, headers=request_headers) for url, request_headers in url_headers)
+            )
+        for response in responses:
+            response.raise_for_status()
+        return {pathname: json_loads(response.content)["diff"] for pathname, response in zip(pathnames, responses)}
+
+    def diffs(self, from_: int, to_: int, pathnames: list[str]) -> dict[str, list[dict]]:
+        """Fetch the diffs of multiple files concurrently"""
+        if not pathnames:
+            return {}
+        if len(pathnames) == 1:
+            return {pathnames[0]: self.diff(from_, to_, pathnames[0])}
+        # Fetch the CSRF token before going concurrent
+        self.csrf_token
+        # A new HTTP/2 connection costs a TCP and TLS handshake, which only pays off when there are more requests
+        # than the workers sharing the pooled keep-alive connections of the session
+        if httpx is not None and HTTP2_AVAILABLE and len(pathnames) > HTTP_MAX_WORKERS:
+            self.logger.debug("Fetching %d diffs from %d to %d over HTTP/2...", len(pathnames), from_, to_)
+            try:
+                return asyncio.run(self._diffs_http2(from_, to_, pathnames))
+            except httpx.HTTPError as e:
+                # Session expiry and other errors are handled by the synchronous path
+                self.logger.debug("Failed to fetch diffs over HTTP/2, falling back: %s", e)
+        with ThreadPoolExecutor(max_workers=HTTP_MAX_WORKERS) as executor:
+            return dict(zip(pathnames, executor.map(lambda _: self.diff(from_, to_, _), pathnames)))
 
     def find_id_type(self, pathname: str) -> tuple[str, str] | tuple[None, None]:
         self.logger.debug("Finding id for `%s`...", pathname)
@@ -416,15 +812,9 @@ class OverleafBroker:
         if pathname == "":
             return self.root_folder_id, "folder"
 
-        ids = self.indexed_ids
-        if pathname in ids["fileRefs"]:
-            id, type = ids["fileRefs"][pathname], "file"
-        elif pathname in ids["docs"]:
-            id, type = ids["docs"][pathname], "doc"
-        elif pathname in ids["folders"]:
-            id, type = ids["folders"][pathname], "folder"
-        else:
+        if (id_type := self.flat_ids.get(pathname)) is None:
             return (None, None)
+        id, type = id_type
         self.logger.debug("Found file ID for `%s`: %s (%s)", pathname, id, type)
         return id, type
 
@@ -440,9 +830,9 @@ class OverleafBroker:
         except requests.HTTPError as e:
             self.logger.error("Failed to download file %s:\n%s", pathname, e)
             return False
-        if dirname := os.path.dirname(pathname):
-            os.makedirs(dirname, exist_ok=True)
-        with open(os.path.join(self.working_dir, pathname), "wb") as f:
+        path = os.path.join(self.working_dir, pathname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
             f.write(response.content)
         self.logger.debug("Succeed to download file %s...", pathname)
         return True
@@ -459,9 +849,9 @@ class OverleafBroker:
         except requests.HTTPError as e:
             self.logger.error("Failed to download doc file %s:\n%s", pathname, e)
             return False
-        if dirname := os.path.dirname(pathname):
-            os.makedirs(dirname, exist_ok=True)
-        with open(os.path.join(self.working_dir, pathname), "wb") as f:
+        path = os.path.join(self.working_dir, pathname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
             f.write(response.content)
         self.logger.debug("Succeed to download doc file %s...", pathname)
         return True
@@ -471,23 +861,33 @@ class OverleafBroker:
         response = self._get(f"{OVERLEAF_URL}/socket.io/1/?projectId={self.project_id}")
         ws_id = response.text.split(":")[0]
         ws = websocket.create_connection(
-            f"wss://overleaf.s3lab.io/socket.io/1/websocket/{ws_id}?projectId={self.project_id}"
+            f"wss://overleaf.s3lab.io/socket.io/1/websocket/{ws_id}?projectId={self.project_id}",
+            timeout=WEBSOCKET_TIMEOUT,
+            sockopt=((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),),
+            # The payload is validated by the JSON parser; skip the extra UTF-8 pass over every frame
+            skip_utf8_validation=True,
         )
-        while True:
-            try:
-                data = ws.recv()
-                assert isinstance(data, str)
-            except websocket.WebSocketConnectionClosedException:
-                self.logger.critical("WebSocket connection closed")
-                exit(ErrorNumber.HTTP_ERROR)
-            else:
-                if data.startswith("5:::"):
-                    data_json = json.loads(data[4:])
+        try:
+            while True:
+                # Inspect the raw frame and only decode the one carrying the project
+                opcode, frame = ws.recv_data_frame()
+                if opcode == websocket.ABNF.OPCODE_CLOSE:
+                    raise websocket.WebSocketConnectionClosedException()
+                if frame.data.startswith(b"5:::"):
+                    # Slice a view rather than copying the (possibly multi-megabyte) project payload
+                    data_json = json_loads(memoryview(frame.data)[4:])
                     response_name = data_json["name"]
                     self.logger.debug("WebSocket response: %s", response_name)
                     if response_name == "joinProjectResponse":
                         break
-        ws.close()
+        except websocket.WebSocketConnectionClosedException:
+            self.logger.critical("WebSocket connection closed")
+            exit(ErrorNumber.HTTP_ERROR)
+        except websocket.WebSocketTimeoutException:
+            self.logger.critical("Timed out waiting for the project from WebSocket after %d seconds", WEBSOCKET_TIMEOUT)
+            exit(ErrorNumber.HTTP_ERROR)
+        finally:
+            ws.close()
 
         ids = data_json["args"][0]["project"]["rootFolder"][0]
         if not ids:
@@ -499,10 +899,18 @@ class OverleafBroker:
         if self._original_file_ids:
             return self._original_file_ids
         self._original_file_ids = self._get_root_folder_json()
-        with open(self.ids_file, "w") as f:
-            json.dump(self._original_file_ids, f)
+        self._dump_ids(self.ids_file, self._original_file_ids)
         return self._original_file_ids
 
+    def _dump_ids(self, ids_file: str, ids: dict) -> None:
+        # Write atomically so that a reader never sees a partially written file.
+        # Each writer gets its own temporary file, so concurrent runs cannot move or truncate each other's.
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=self.overleaf_sync_dir, prefix=f"{os.path.basename(ids_file)}.", suffix=".tmp", delete=False
+        ) as f:
+            f.write(json_dumps(ids))
+        os.replace(f.name, ids_file)
+
     @property
     def root_folder_id(self) -> str:
         # return self._root_folder_id if self._root_folder_id else hex(int(self._project_id, 16) - 1)[2:].lower()
@@ -513,24 +921,46 @@ class OverleafBroker:
             raise RuntimeError("Failed to fetch root folder ID")
         return self._root_folder_id
 
-    def upload(self, pathname: str, dry_run=False) -> None:
+    def _upload_folder_id(self, pathname: str) -> str:
+        """Resolve the ID of the folder to upload `pathname` into, creating the folder if necessary"""
+        folder_name = os.path.dirname(pathname)
+        if folder_name == "":
+            return self.root_folder_id
+        folder_id, type = self.find_id_type(folder_name)
+        if folder_id is None:
+            return self.create_folder(folder_name)
+        assert type == "folder"
+        return folder_id
+
+    def upload_many(self, pathnames: list[str], dry_run=False) -> None:
         """
-        Upload the file to the Overleaf project.
+        Upload multiple files to the Overleaf project concurrently, sharing the upload rate limiter.
         There is a rate limit of 200 request per 15 minutes.
+        Large files are uploaded by fewer workers to avoid saturating the upstream bandwidth.
         """
-        self.logger.info("Uploading `%s`...", pathname)
-        if dry_run:
+        for pathname in pathnames:
+            self.logger.info("Uploading `%s`...", pathname)
+        if dry_run or not pathnames:
             return
-
-        folder_name = os.path.dirname(pathname)
-        if folder_name != "":
-            folder_id, type = self.find_id_type(folder_name)
-            if folder_id is None:
-                folder_id = self.create_folder(folder_name)
-            else:
-                assert type == "folder"
-        else:
-            folder_id = self.root_folder_id
+        # Folders are resolved and created sequentially, since creating a folder refreshes the ID index
+        folder_ids = [self._upload_folder_id(_) for _ in pathnames]
+        self.csrf_token
+        small_files: list[tuple[str, str]] = []
+        large_files: list[tuple[str, str]] = []
+        for pathname, folder_id in zip(pathnames, folder_ids):
+            is_large = os.path.getsize(os.path.join(self.working_dir, pathname)) > UPLOAD_LARGE_FILE_SIZE
+            (large_files if is_large else small_files).append((pathname, folder_id))
+        with (
+            ThreadPoolExecutor(max_workers=HTTP_MAX_WORKERS) as small_executor,
+            ThreadPoolExecutor(max_workers=UPLOAD_LARGE_MAX_WORKERS) as large_executor,
+        ):
+            futures = [small_executor.submit(self._upload_file, *_) for _ in small_files]
+            futures += [large_executor.submit(self._upload_file, *_) for _ in large_files]
+            # Propagate exceptions raised in workers
+            for future in futures:
+                future.result()
+
+    def _upload_file(self, pathname: str, folder_id: str) -> None:
         file_name = os.path.basename(pathname)
 
         url = f"{PROJECTS_URL}/{self.project_id}/upload"
@@ -546,26 +976,57 @@ class OverleafBroker:
             "type": "application/octet-stream",
             "name": file_name,
         }
-        with open(os.path.join(self.working_dir, pathname), "rb") as qqfile:
-            files = {
-                "qqfile": (file_name, qqfile, "application/octet-stream"),
-            }
-            self._post(url, headers=headers, params=params, data=data, files=files)
+
+        def _post_qqfile() -> None:
+            path = os.path.join(self.working_dir, pathname)
+            if os.path.getsize(path) <= UPLOAD_LARGE_FILE_SIZE:
+                # Small files are read at once, which also lets `_request` replay the body after a re-login
+                with open(path, "rb") as qqfile:
+                    qqfile_field = (file_name, qqfile.read(), "application/octet-stream")
+                self._post(url, headers=headers, params=params, data=data, files={"qqfile": qqfile_field})
+                return
+            with open(path, "rb") as qqfile:
+                qqfile_field = (file_name, qqfile, "application/octet-stream")
+                if MultipartEncoder is None:
+                    self._post(url, headers=headers, params=params, data=data, files={"qqfile": qqfile_field})
+                    return
+                # Stream the multipart body from the file instead of assembling it in memory
+                encoder = MultipartEncoder(fields={**data, "qqfile": qqfile_field})
+                headers["Content-Type"] = encoder.content_type
+                self._post(url, headers=headers, params=params, data=encoder)
+
+        for attempt in range(1, UPLOAD_MAX_ATTEMPTS + 1):
+            self._upload_rate_limiter.acquire()
+            try:
+                _post_qqfile()
+                self._upload_rate_limiter.recover()
+                return
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code not in (429, 503):
+                    raise
+                if attempt == UPLOAD_MAX_ATTEMPTS:
+                    raise RuntimeError(
+                        f"Upload of `{pathname}` still throttled after {UPLOAD_MAX_ATTEMPTS} attempts"
+                    ) from e
+                retry_after = parse_retry_after(e.response.headers.get("Retry-After"))
+                self.logger.warning("Upload of `%s` throttled. Retrying in %.0f seconds...", pathname, retry_after)
+                self._upload_rate_limiter.penalize(retry_after)
 
     def _get_indexed_ids(self) -> dict[str, dict[str, str]]:
         ids: dict[str, dict[str, str]] = {"folders": {}, "fileRefs": {}, "docs": {}}
 
-        def _restructure(folder_json: dict, current_folder_pathname="") -> None:
+        # Iterative DFS carrying the parent path components, joined once per folder
+        stack: deque[tuple[dict, tuple[str, ...]]] = deque([(self.root_folder_json, ())])
+        while stack:
+            folder_json, parts = stack.pop()
+            prefix = "/".join(parts) + "/" if parts else ""
             for sub_folder in folder_json["folders"]:
-                sub_folder_pathname = f'{current_folder_pathname}{sub_folder["name"]}'
-                ids["folders"][sub_folder_pathname] = sub_folder["_id"]
-                _restructure(sub_folder, f"{sub_folder_pathname}/")
+                ids["folders"][prefix + sub_folder["name"]] = sub_folder["_id"]
+                stack.append((sub_folder, parts + (sub_folder["name"],)))
             for doc in folder_json["docs"]:
-                ids["docs"][f'{current_folder_pathname}{doc["name"]}'] = doc["_id"]
+                ids["docs"][prefix + doc["name"]] = doc["_id"]
             for file_ref in folder_json["fileRefs"]:
-                ids["fileRefs"][f'{current_folder_pathname}{file_ref["name"]}'] = file_ref["_id"]
-
-        _restructure(self.root_folder_json)
+                ids["fileRefs"][prefix + file_ref["name"]] = file_ref["_id"]
         return ids
 
     @property
@@ -573,14 +1034,27 @@ class OverleafBroker:
         if self._indexed_file_ids:
             return self._indexed_file_ids
         self._indexed_file_ids = self._get_indexed_ids()
-        with open(self.indexed_ids_file, "w") as f:
-            json.dump(self._indexed_file_ids, f)
+        self._dump_ids(self.indexed_ids_file, self._indexed_file_ids)
         return self._indexed_file_ids
 
+    @property
+    def flat_ids(self) -> dict[str, tuple[str, str]]:
+        """Map pathname to (ID, type) so that a lookup is a single probe"""
+        if self._flat_ids is None:
+            ids = self.indexed_ids
+            # Files take precedence over docs over folders on a pathname clash, as in the previous lookup order
+            self._flat_ids = {
+                **{k: (v, "folder") for k, v in ids["folders"].items()},
+                **{k: (v, "doc") for k, v in ids["docs"].items()},
+                **{k: (v, "file") for k, v in ids["fileRefs"].items()},
+            }
+        return self._flat_ids
+
     def refresh_indexed_file_ids(self) -> None:
         self.logger.debug("Indexed file IDs marked outdated...")
         self._original_file_ids = None
         self._indexed_file_ids = None
+        self._flat_ids = None
 
     def create_folder(self, pathname: str, dry_run=False) -> str:
         self.logger.info("Creating folder %s...", pathname)
@@ -607,12 +1081,13 @@ class OverleafBroker:
             "X-CSRF-TOKEN": self.csrf_token,
         }
         data = {"name": os.path.basename(pathname), "parent_folder_id": parent_folder_id}
-        response_json = self._post(url, headers=headers, data=data).json()
+        response_json = json_loads(self._post(url, headers=headers, data=data).content)
         self.refresh_indexed_file_ids()
         self.logger.info("Folder %s created", pathname)
         return response_json["_id"]
 
-    def delete(self, pathname: str, dry_run=False) -> None:
+    def _confirm_delete(self, pathname: str) -> tuple[str, str] | tuple[None, None] | None:
+        """Resolve the ID and type of `pathname` to delete. Return `None` if the deletion is cancelled."""
         id, type = self.find_id_type(pathname)
         self.logger.info("Deleting `%s`(%s): %s", pathname, type, id)
 
@@ -620,11 +1095,12 @@ class OverleafBroker:
             f"Are you sure you want to delete folder {pathname}? (y/n): "
         ).strip().lower() not in ["y", "yes"]:
             self.logger.info("Operation cancelled")
-            return
-
-        if dry_run:
-            return
+            return None
+        return id, type
 
+    def _delete_entity(self, id: str | None, type: str | None) -> None:
+        if type not in ["file", "doc", "folder"]:
+            raise ValueError(f"Invalid type: {type}")
         url = f"{self.project_url}/{type}/{id}"
         headers = {
             "Accept": "application/json",
@@ -632,10 +1108,23 @@ class OverleafBroker:
             "Referer": self.project_url,
             "X-CSRF-TOKEN": self.csrf_token,
         }
-        if type not in ["file", "doc", "folder"]:
-            raise ValueError(f"Invalid type: {type}")
         self._delete(url, headers=headers)
 
+    def delete_many(self, pathnames: list[str], dry_run=False) -> None:
+        """
+        Delete multiple entities from the Overleaf project concurrently.
+        Overleaf has no bulk deletion endpoint, so the DELETE requests are pipelined through a thread pool.
+        Entities must not contain each other, otherwise the deletion order is undefined.
+        """
+        # Resolve IDs, ask for confirmations and fetch the CSRF token before going concurrent
+        entities = [_ for _ in map(self._confirm_delete, pathnames) if _ is not None]
+        if dry_run or not entities:
+            return
+        self.csrf_token
+        with ThreadPoolExecutor(max_workers=HTTP_MAX_WORKERS) as executor:
+            # Consume the results to propagate exceptions raised in workers
+            list(executor.map(lambda entity: self._delete_entity(*entity), entities))
+
     def set_label(self, version: int, label: str) -> None:
         self.logger.info("Labelling version %d as `%s`...", version, label)
         url = f"{PROJECTS_URL}/{self.project_id}/label"
@@ -661,11 +1150,21 @@ class OverleafBroker:
             "X-CSRF-TOKEN": self.csrf_token,
         }
         response = self._get(url, headers=headers)
-        return response.json()
+        return json_loads(response.content)
 
 
 class OverleafProject:
     logger = logging.getLogger(__qualname__)
+    # `git diff --name-status` status -> (number of columns, handler(columns, delete_list, upload_list))
+    PUSH_STATUS_HANDLERS: dict[str, tuple[int, Callable[[list[str], list[str], list[str]], Any]]] = {
+        "M": (2, lambda columns, delete_list, upload_list: upload_list.append(columns[1])),
+        "A": (2, lambda columns, delete_list, upload_list: upload_list.append(columns[1])),
+        "D": (2, lambda columns, delete_list, upload_list: delete_list.append(columns[1])),
+        "R100": (
+            3,
+            lambda columns, delete_list, upload_list: (delete_list.append(columns[1]), upload_list.append(columns[2])),
+        ),
+    }
 
     def __init__(self, working_dir: str = ".") -> None:
         self.working_dir = working_dir
@@ -726,28 +1225,56 @@ class OverleafProject:
             exit(ErrorNumber.HTTP_ERROR)
         self.overleaf_broker.unzip()
 
+    def _apply_changes_files(self, from_v: int, to_v: int, filetree_diff_entries: list[dict]) -> bool:
+        """
+        Fetch and apply the changes of the latest overleaf update by downloading only the changed files.
+        Docs are rebuilt from their diffs at `to_v`, since a doc download returns its live content.
+        Files are downloaded by their current IDs, so this only applies to the latest update.
+        Return `False` if any changed file cannot be resolved or downloaded.
+        """
+        doc_pathnames: list[str] = []
+        downloads: list[tuple[str, str]] = []
+        for filetree_diff_entry in filetree_diff_entries:
+            match filetree_diff_entry["operation"]:
+                case "added" | "edited":
+                    pathname = filetree_diff_entry["pathname"]
+                case "renamed":
+                    pathname = filetree_diff_entry["newPathname"]
+                case _:
+                    continue
+            if filetree_diff_entry.get("editable", True):
+                doc_pathnames.append(pathname)
+                continue
+            # A replaced file gets a new ID, so a file ID always refers to the same content
+            id, type = self.overleaf_broker.find_id_type(pathname)
+            if id is None or type != "file":
+                self.logger.debug("Failed to resolve `%s` for per-file download", pathname)
+                return False
+            downloads.append((id, pathname))
+
+        diffs = self.overleaf_broker.diffs(from_v, to_v, doc_pathnames)
+        for filetree_diff_entry in filetree_diff_entries:
+            pathname = filetree_diff_entry["pathname"]
+            if filetree_diff_entry["operation"] in ("removed", "renamed"):
+                self.logger.info("Remove `%s`...", pathname)
+                self._remove(os.path.join(self.working_dir, pathname))
+        for pathname in doc_pathnames:
+            self.logger.info("Add/Edit `%s`...", pathname)
+            path = os.path.join(self.working_dir, pathname)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(diff_to_content(diffs[pathname]))
+        with ThreadPoolExecutor(max_workers=HTTP_MAX_WORKERS) as executor:
+            return all(executor.map(lambda _: self.overleaf_broker.download_file(*_), downloads))
+
     def _apply_changes_diff(self, from_v: int, to_v: int, filetree_diff_entries: list[dict]) -> None:
         """
         Fetch and apply the changes between two overleaf updates via filetree diff.
         """
-
-        def _diff_to_content(diff: list[dict]) -> str:
-            exclusive_status = {"u", "i", "d"}
-            content = ""
-
-            for d in diff:
-                found_status = exclusive_status.intersection(d.keys())
-                assert len(found_status) == 1
-                status = found_status.pop()
-                match status:
-                    case "u" | "i":
-                        content += d[status]
-                    case "d":
-                        pass
-                    case _:
-                        raise ValueError(f"Unsupported diff status: {status}")
-            return content
-
+        # Fetch the diffs concurrently while keeping the filesystem operations serial
+        diffs = self.overleaf_broker.diffs(
+            from_v, to_v, [_["pathname"] for _ in filetree_diff_entries if _["operation"] in ("added", "edited")]
+        )
         for filetree_diff_entry in filetree_diff_entries:
             pathname = filetree_diff_entry["pathname"]
             operation = filetree_diff_entry["operation"]
@@ -756,8 +1283,9 @@ class OverleafProject:
                 case "added" | "edited":
                     self.logger.info("Add/Edit `%s`...", pathname)
                     os.makedirs(os.path.dirname(path), exist_ok=True)
-                    with open(path, "w") as f:
-                        f.write(_diff_to_content(self.overleaf_broker.diff(from_v, to_v, pathname)))
+                    # Write the encoded content in one call, bypassing the text layer and its newline translation
+                    with open(path, "wb") as f:
+                        f.write(diff_to_content(diffs[pathname]))
                 case "removed":
                     self.logger.info("Remove `%s`...", pathname)
                     self._remove(path)
@@ -780,19 +1308,31 @@ class OverleafProject:
             entry for entry in self.overleaf_broker.filetree_diff(from_v, to_v) if "operation" in entry
         ]
 
+        # Only the ZIP migration may touch files outside of the filetree diff
+        stage_all = False
         if all(_.get("editable", True) or _["operation"] in ("removed", "renamed") for _ in filetree_diff_entries):
             # if all(self.overleaf_broker.find_id_type(_["pathname"])[1] == "doc" for _ in filetree_diff_entries):
             self._apply_changes_diff(from_v, to_v, filetree_diff_entries)
+        elif to_v == self.overleaf_broker.remote_overleaf_version and self._apply_changes_files(
+            from_v, to_v, filetree_diff_entries
+        ):
+            self.logger.info("Applied per-file migration: %d", to_v)
         else:
             self.logger.info("Switch to ZIP migration: %d", to_v)
             self._apply_changes_zip(to_v, filetree_diff_entries)
+            stage_all = True
 
-        self.git_broker.add_all()
+        # New files have to be staged with `git add .`, which skips ignored files and keeps the command line short.
+        # Otherwise modifications and deletions of tracked files are staged by `commit --all` alone.
+        stage_all = stage_all or any(_["operation"] in ("added", "renamed") for _ in filetree_diff_entries)
+        if stage_all:
+            self.git_broker.add_all()
         self.git_broker.commit(
             f"{from_v}->{to_v}",
             ts,
             f"{user.get("last_name", "")}, {user.get("first_name", "")}",
             user.get("email", ""),
+            all=not stage_all,
         )
         self.logger.debug("Update migrated: %d->%d", from_v, to_v)
 
@@ -807,16 +1347,15 @@ class OverleafProject:
             _users = []
             _ts = 0
             seen_ids = set()
-            for filetree_diff in self.overleaf_broker.filetree_diff(from_, to_):
-                if "operation" not in filetree_diff:
-                    continue
-                for diff in self.overleaf_broker.diff(from_, to_, pathname=filetree_diff["pathname"]):
-                    if "i" in diff or "d" in diff:
-                        for u in diff["meta"]["users"]:
-                            if u["id"] not in seen_ids:
-                                _users.append(u)
-                                seen_ids.add(u["id"])
-                        _ts = max(_ts, diff["meta"]["end_ts"])
+            pathnames = [_["pathname"] for _ in self.overleaf_broker.filetree_diff(from_, to_) if "operation" in _]
+            # Fetch the diffs of all files in the revision at once instead of one round trip after another
+            for diff in chain.from_iterable(self.overleaf_broker.diffs(from_, to_, pathnames).values()):
+                if "i" in diff or "d" in diff:
+                    for u in diff["meta"]["users"]:
+                        if u["id"] not in seen_ids:
+                            _users.append(u)
+                            seen_ids.add(u["id"])
+                    _ts = max(_ts, diff["meta"]["end_ts"])
             return _users, _ts
 
         fromV = update["fromV"]
@@ -944,9 +1483,9 @@ class OverleafProject:
         """Perform pull operation"""
         # Get all new overleaf updates
         local_overleaf_version = self.git_broker.local_overleaf_version
-        upcoming_overleaf_versions = list(
-            takewhile(lambda rev: rev["toV"] > local_overleaf_version, self.overleaf_broker.updates)
-        )
+        # Updates are sorted by descending `toV`; binary search the first one already migrated
+        updates = self.overleaf_broker.updates
+        upcoming_overleaf_versions = updates[: bisect_left(updates, -local_overleaf_version, key=lambda _: -_["toV"])]
         assert len(upcoming_overleaf_versions) > 0
 
         # The corresponding remove overleaf update of latest local overleaf update may changed after the migration
@@ -1005,27 +1544,26 @@ class OverleafProject:
     @property
     def empty_folders(self) -> list[str]:
         empty_folders: list[str] = []
-
-        def _traverse_folders(folder_json: dict, parent_folder_pathname: str = "") -> None:
-            folder_pathname = (
-                f'{parent_folder_pathname}/{folder_json["name"]}' if parent_folder_pathname else folder_json["name"]
+        is_empty: dict[str, bool] = {}
+
+        # Iterative post-order traversal: a folder is revisited (`exiting`) after all its sub folders.
+        # Sub folders are pushed in reverse to keep the order of the recursive traversal.
+        root_folders = self.overleaf_broker.root_folder_json["folders"]
+        stack: list[tuple[dict, str, bool]] = [(_, _["name"], False) for _ in reversed(root_folders)]
+        while stack:
+            folder_json, folder_pathname, exiting = stack.pop()
+            if not exiting:
+                stack.append((folder_json, folder_pathname, True))
+                stack.extend((_, f'{folder_pathname}/{_["name"]}', False) for _ in reversed(folder_json["folders"]))
+                continue
+            is_empty[folder_json["_id"]] = (
+                all(is_empty[_["_id"]] for _ in folder_json["folders"])
+                and not folder_json["fileRefs"]
+                and not folder_json["docs"]
             )
-
-            for sub_folder in folder_json["folders"]:
-                _traverse_folders(sub_folder, folder_pathname)
-                if sub_folder["_id"] not in empty_folders:
-                    all_sub_folders_empty = False
-                    break
-            else:
-                all_sub_folders_empty = True
-
-            if all_sub_folders_empty and not folder_json["fileRefs"] and not folder_json["docs"]:
+            if is_empty[folder_json["_id"]]:
                 empty_folders.append(folder_pathname)
 
-        # Start checking from the root level folders
-        for folder in self.overleaf_broker.root_folder_json["folders"]:
-            _traverse_folders(folder)
-
         return empty_folders
 
     def _push(self, dry_run: bool) -> None:
@@ -1033,41 +1571,31 @@ class OverleafProject:
         self.git_broker.switch_to_working_branch()
         delete_list: list[str] = []
         upload_list: list[str] = []
-        for line in self.git_broker.working_branch_status:
-            self.logger.info("status: %s", line)
-            columns = line.split("\t")
+        for columns in self.git_broker.working_branch_status:
+            self.logger.info("status: %s", "\t".join(columns))
             status = columns[0]
-            match status:
-                case "M" | "A":
-                    assert len(columns) == 2
-                    pathname = columns[1]
-                    upload_list.append(pathname)
-                case "D":
-                    assert len(columns) == 2
-                    pathname = columns[1]
-                    delete_list.append(pathname)
-                case "R100":
-                    assert len(columns) == 3
-                    old_pathname, new_pathname = columns[1], columns[2]
-                    delete_list.append(old_pathname)
-                    upload_list.append(new_pathname)
-                case _:
-                    raise ValueError(f"Unsupported status: {status}")
+            if status not in self.PUSH_STATUS_HANDLERS:
+                raise ValueError(f"Unsupported status: {status}")
+            num_columns, handler = self.PUSH_STATUS_HANDLERS[status]
+            assert len(columns) == num_columns
+            handler(columns, delete_list, upload_list)
 
         assert len(delete_list) + len(upload_list) > 0
 
-        for pathname in delete_list:
-            self.overleaf_broker.delete(pathname, dry_run)
-        for pathname in upload_list:
-            self.overleaf_broker.upload(pathname, dry_run)
+        self.overleaf_broker.delete_many(delete_list, dry_run)
+        self.overleaf_broker.upload_many(upload_list, dry_run)
         # It is possible that the refresh happened after changes from other remote overleaf users
         # The push verification may fail in this case
         self.overleaf_broker.refresh_updates()
         self.overleaf_broker.refresh_indexed_file_ids()
 
     def _push_prune(self, dry_run: bool) -> None:
-        for pathname in self.empty_folders:
-            self.overleaf_broker.delete(pathname, dry_run)
+        # Sub folders of an empty folder are empty as well and are deleted together with it,
+        # so only the outermost ones are deleted, which also keeps the concurrent deletions independent
+        empty_folders = self.empty_folders
+        empty_folder_set = set(empty_folders)
+        outermost_empty_folders = [_ for _ in empty_folders if os.path.dirname(_) not in empty_folder_set]
+        self.overleaf_broker.delete_many(outermost_empty_folders, dry_run)
 
     def push(self, prune=False, dry_run=False) -> ErrorNumber:
         if not self.initialized:
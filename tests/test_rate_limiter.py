@@ -0,0 +1,69 @@
+import unittest
+from unittest import mock
+
+import overleaf_sync
+from overleaf_sync import RateLimiter
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.sleeps: list[float] = []
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        for name in ("time", "sleep"):
+            patcher = mock.patch.object(overleaf_sync, name, getattr(self.clock, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_concurrent_throttles_halve_rate_once(self) -> None:
+        limiter = RateLimiter(0.2, burst=8)
+        for _ in range(8):
+            limiter.acquire()
+        # Every in-flight worker gets a 429 and retries while the others are still waiting
+        for _ in range(8):
+            self.clock.now += 0.01
+            limiter.penalize(5)
+            limiter.acquire()
+        self.assertAlmostEqual(limiter.rate, 0.1)
+
+    def test_rate_floor_is_relative(self) -> None:
+        limiter = RateLimiter(0.2)
+        for _ in range(10):
+            limiter.penalize(5)
+            self.clock.now += 10
+        self.assertAlmostEqual(limiter.rate, 0.2 / 8)
+
+    def test_rate_recovers_after_window(self) -> None:
+        limiter = RateLimiter(0.2)
+        limiter.penalize(5)
+        limiter.recover()
+        self.assertAlmostEqual(limiter.rate, 0.1)
+        self.clock.now += 5
+        for _ in range(8):
+            limiter.recover()
+        self.assertAlmostEqual(limiter.rate, 0.2)
+
+    def test_penalty_keeps_elapsed_refill(self) -> None:
+        limiter = RateLimiter(1, min_rate=1)
+        limiter.acquire()
+        limiter.penalize(1)
+        limiter.acquire()
+        # The retry is sent once its reservation is due, and is throttled again
+        self.clock.now += self.clock.sleeps[-1]
+        limiter.penalize(0)
+        limiter.acquire()
+        self.assertAlmostEqual(self.clock.sleeps[-1], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()